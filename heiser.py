@@ -4,15 +4,42 @@
 
 import argparse
 import calendar
+import concurrent.futures
+import contextlib
+import copy
+import fcntl
+import gzip
 import html5lib
+import json
 import logging
 import os
 import re
 import requests
 import sys
+import tempfile
+import threading
 import time
+import tomllib
+import urllib.parse
+import zlib
 # since Python >= 3.3 xml.etree.cElementTree is deprecated
 import xml.etree.ElementTree as ET
+try:
+    # Python >= 3.14
+    from compression import zstd
+    zstd_compress   = zstd.compress
+    zstd_decompress = zstd.decompress
+    ZstdError       = zstd.ZstdError
+    HAVE_ZSTD = True
+except ImportError:
+    try:
+        import zstandard
+        zstd_compress   = lambda b: zstandard.ZstdCompressor().compress(b)
+        zstd_decompress = lambda b: zstandard.ZstdDecompressor().decompress(b)
+        ZstdError       = zstandard.ZstdError
+        HAVE_ZSTD = True
+    except ImportError:
+        HAVE_ZSTD = False
 
 ans = '{http://www.w3.org/2005/Atom}'
 xns = '{http://www.w3.org/1999/xhtml}'
@@ -51,18 +78,32 @@ def mk_arg_parser():
         help='cache directory (default: $HOME/.cache/heiser)')
     p.add_argument('--feed', metavar='FILE', nargs='?', const='heise-atom.xml',
         help='read feed from a FILE instead the URL')
+    p.add_argument('--feeds', metavar='TOML',
+        help=('process multiple feeds (url, output and optional filter) that'
+              ' are configured in a TOML file'))
     p.add_argument('--feed-url',
         default=default_heise_feed_url,
         help='URL of the heise.de ATOM news feed (default: %(default)s)')
     p.add_argument('--log', nargs='?', metavar='FILE',
         const='heiser.log', help='log all messages into FILE')
+    p.add_argument('--rebuild-cache-index', action='store_true',
+        help='recreate the cache index from the cache directory contents')
     p.add_argument('--output', '-o', metavar='FILE', default='heiser.xml',
         help='augmented ATOM feed (default: %(default)s)')
     p.add_argument('--verbose', '-v', action='store_true',
         help='turn on verbose logging')
     p.add_argument('--filter', help=('Filter entries based on the title'
-        ' (i.e. no ads/TechStage/heise+) (default: %(default)s)'), nargs=1,
+        ' (i.e. no ads/TechStage/heise+) (default: %(default)s)'),
         default='Anzeige:|TechStage|heise\\+')
+    p.add_argument('--force', '-f', action='store_true',
+        help="process the feed even if it hasn't changed since the last run")
+    p.add_argument('--incremental', '-i', action='store_true',
+        help=('reuse the augmented entries of the previous output'
+              ' and only extract articles of new entries'))
+    p.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+        help='fetch and clean up to N articles in parallel (default: %(default)s)')
+    p.add_argument('--host-jobs', type=int, default=4, metavar='N',
+        help='max. concurrent requests per host (default: %(default)s)')
     return p
 
 def parse_args(*a):
@@ -76,30 +117,403 @@ def parse_args(*a):
         args.cache = os.environ['HOME'] + '/.cache/heiser'
     return args
 
+# per-host connection limit, shared by all fetching threads
+host_limit = 4
+host_sems = {}
+host_sems_lock = threading.Lock()
+
+def host_semaphore(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with host_sems_lock:
+        if host not in host_sems:
+            host_sems[host] = threading.BoundedSemaphore(host_limit)
+        return host_sems[host]
+
+def mk_session(jobs=1):
+    session = requests.Session()
+    if jobs > 1:
+        # otherwise urllib3 discards connections beyond its default
+        # pool size of 10 ...
+        a = requests.adapters.HTTPAdapter(pool_maxsize=jobs)
+        session.mount('https://', a)
+        session.mount('http://', a)
+    return session
+
+charset_re = re.compile('charset\\s*=\\s*["\']?([^"\';\\s]+)', re.I)
+
+# returns the raw body and the encoding declared in the HTTP header (if any),
+# i.e. we don't use r.text as requests might fall back to its
+# comparatively slow charset detection on the whole body
 def get_resource(url, session):
-    log.debug('Getting: {}'.format(url))
-    r = session.get(url)
+    with host_semaphore(url):
+        log.debug('Getting: {}'.format(url))
+        r = session.get(url)
+    r.raise_for_status()
+    m = charset_re.search(r.headers.get('Content-Type', ''))
+    return (r.content, m.group(1) if m else None)
+
+# conditional GET, i.e. validators is a dict with optional etag/modified
+# keys that were obtained from the previous response
+#
+# returns (None, validators) if the resource is unchanged
+def get_modified_resource(url, session, validators):
+    headers = {}
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'modified' in validators:
+        headers['If-Modified-Since'] = validators['modified']
+    with host_semaphore(url):
+        log.debug('Getting: {} ({})'.format(url, headers))
+        r = session.get(url, headers=headers)
+    if r.status_code == 304:
+        return (None, validators)
     r.raise_for_status()
-    return r.text
+    vs = {}
+    if 'ETag' in r.headers:
+        vs['etag'] = r.headers['ETag']
+    if 'Last-Modified' in r.headers:
+        vs['modified'] = r.headers['Last-Modified']
+    return (r.content, vs)
+
+# feed validators and clean_version of previous runs - keyed by
+# output filename
+def state_filename(cache):
+    return '{}/state.json'.format(cache)
+
+def load_state(cache):
+    filename = state_filename(cache)
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except ValueError as e:
+        log.warning('Ignoring broken state file {}: {}'.format(filename, e))
+        return {}
+
+# Serializes updates of the cache directory between processes (and
+# threads), i.e. of index.log and state.json
+cache_thread_lock = threading.Lock()
+
+@contextlib.contextmanager
+def cache_lock(cache):
+    with cache_thread_lock:
+        with open('{}/index.lock'.format(cache), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+# Other processes may share the cache directory, thus, the state is
+# re-read under the lock such that only the key of this feed is replaced.
+def update_state(cache, key, value):
+    filename = state_filename(cache)
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with cache_lock(cache):
+        state = load_state(cache)
+        state[key] = value
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp, filename)
+
+# Manifest of the cached files, i.e. an append-only log where each
+# line either records an added or a removed file:
+#
+#     +<TAB>fetch time<TAB>size<TAB>ID<TAB>name[<TAB>encoding]
+#     -<TAB>name
+#
+# It's read once per run, such that existence and expiry queries
+# don't need any stat calls on the (possibly remote) cache filesystem.
+#
+# Several processes may share the cache directory, thus, appending and
+# compacting is serialized with an flock() on index.lock and compacting
+# re-reads the log, i.e. it keeps records other processes appended since
+# the index was loaded.
+class Cache_Index:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = '{}/index.log'.format(directory)
+        # name -> (fetch time, size, ID, encoding)
+        self.files = {}
+        with self.locked():
+            if os.path.exists(self.filename):
+                self.load()
+            else:
+                self.scan()
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __str__(self):
+        return self.directory
+
+    def path(self, name):
+        return '{}/{}'.format(self.directory, name)
+
+    def locked(self):
+        return cache_lock(self.directory)
+
+    # expects the lock to be held
+    def load(self):
+        self.files = {}
+        with open(self.filename) as f:
+            for line in f:
+                xs = line.rstrip('\n').split('\t')
+                # i.e. ignore a truncated last line
+                try:
+                    if xs[0] == '+' and len(xs) in (5, 6):
+                        self.files[xs[4]] = (float(xs[1]), int(xs[2]), xs[3],
+                                             xs[5] if len(xs) > 5 else '')
+                    elif xs[0] == '-' and len(xs) == 2:
+                        self.files.pop(xs[1], None)
+                except ValueError:
+                    pass
+        log.debug('Loaded {} cache index entries from {}'.format(
+            len(self.files), self.filename))
+
+    # expects the lock to be held
+    def write(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            for name, x in self.files.items():
+                f.write(self.record(name, *x))
+        os.replace(tmp, self.filename)
+
+    # expects the lock to be held
+    def scan(self):
+        log.info('Rebuilding cache index of: ' + self.directory)
+        self.files = {}
+        for fn in os.listdir(self.directory):
+            if fn.endswith(('.heiser', '.heiser.zst', '.heiser.gz')):
+                filename = self.path(fn)
+                self.files[fn] = (os.path.getmtime(filename),
+                                  os.path.getsize(filename), '', '')
+        self.write()
+
+    def rebuild(self):
+        with self.locked():
+            self.scan()
+
+    @staticmethod
+    def record(name, t, size, ident, encoding):
+        return '+\t{}\t{}\t{}\t{}\t{}\n'.format(t, size, ident, name, encoding)
+
+    def add(self, name, ident, size, encoding=None):
+        t = calendar.timegm(time.gmtime())
+        ident = ident.replace('\t', ' ').replace('\n', ' ')
+        encoding = encoding or ''
+        with self.locked():
+            self.files[name] = (t, size, ident, encoding)
+            with open(self.filename, 'a') as f:
+                f.write(self.record(name, t, size, ident, encoding))
+
+    # i.e. the encoding declared by the HTTP response (if any)
+    def encoding(self, name):
+        x = self.files.get(name)
+        if not x or not x[3]:
+            return None
+        return x[3]
+
+    def discard(self, name):
+        with self.locked():
+            if self.files.pop(name, None) is not None:
+                with open(self.filename, 'a') as f:
+                    f.write('-\t{}\n'.format(name))
+
+    # Removes the files fetched before t and compacts the log. The
+    # expiry is decided on the re-read log, i.e. a file another process
+    # fetched again in the meantime is kept.
+    def expire(self, t):
+        with self.locked():
+            self.load()
+            names = [ name for name, x in self.files.items() if x[0] < t ]
+            for name in names:
+                filename = self.path(name)
+                log.debug('Removing cached item: ' + filename)
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                del self.files[name]
+            if names:
+                self.write()
+        return names
+
+def test_cache_index():
+    with tempfile.TemporaryDirectory() as d:
+        a = Cache_Index(d)
+        b = Cache_Index(d)
+        a.add('x.heiser.gz', 'x', 1)
+        b.add('y.heiser.gz', 'y', 1)
+        b.files['y.heiser.gz'] = (0, 1, 'y', '')
+        # i.e. b's stale view of y isn't used and a's record survives
+        assert b.expire(1) == []
+        c = Cache_Index(d)
+        assert 'x.heiser.gz' in c and 'y.heiser.gz' in c
+        t = calendar.timegm(time.gmtime()) + 10
+        assert sorted(a.expire(t)) == ['x.heiser.gz', 'y.heiser.gz']
+        assert Cache_Index(d).files == {}
+
+# Raw article pages are cached compressed, i.e. with zstd if available
+# and gzip otherwise. Each codec is a tuple of suffix, compress and
+# decompress function. New files are written with the first codec,
+# whereas uncompressed files of older versions are migrated when read.
+cache_codecs = []
+# NB: corrupt deflate data raises zlib.error, which isn't an OSError
+cache_errors = (OSError, EOFError, zlib.error)
+if HAVE_ZSTD:
+    cache_codecs.append( ('.heiser.zst', zstd_compress, zstd_decompress) )
+    cache_errors += (ZstdError,)
+cache_codecs.append( ('.heiser.gz', lambda b: gzip.compress(b, 6),
+                      gzip.decompress) )
+cache_codecs.append( ('.heiser', None, None) )
+
+def write_cached(cache, i, ident, b, encoding):
+    suffix, compress, _ = cache_codecs[0]
+    name = i + suffix
+    filename = cache.path(name)
+    x = compress(b)
+    tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(x)
+    os.replace(tmp, filename)
+    cache.add(name, ident, len(x), encoding)
+
+# returns (body, encoding) or None
+def read_cached(cache, i, ident):
+    for suffix, _, decompress in cache_codecs:
+        name = i + suffix
+        if name not in cache:
+            continue
+        filename = cache.path(name)
+        encoding = cache.encoding(name)
+        log.debug('Found ID {} under {}'.format(ident, filename))
+        try:
+            with open(filename, 'rb') as f:
+                b = f.read()
+            if decompress:
+                return (decompress(b), encoding)
+        except cache_errors as e:
+            log.warning('Ignoring unreadable cached file {}: {}'.format(filename, e))
+            cache.discard(name)
+            continue
+        log.debug('Migrating uncompressed cache file: ' + filename)
+        write_cached(cache, i, ident, b, encoding)
+        os.remove(filename)
+        cache.discard(name)
+        return (b, encoding)
+    return None
 
 san_re = re.compile('[^A-Za-z0-9_-]')
 
+# returns the raw article page and its HTTP declared encoding (if any)
 def get_article(link, ident, cache, session):
     i = san_re.sub('_', ident)
-    filename = '{}/{}.heiser'.format(cache, i)
-    if os.path.exists(filename):
-        log.debug('Found ID {} under {}'.format(ident, cache))
-        return open(filename, 'r')
-    else:
-        url = link.split('?')[0] + '?seite=all'
-        s = get_resource(url, session)
-        with open(filename, 'w') as f:
-            f.write(s)
-        return s
+    r = read_cached(cache, i, ident)
+    if r is not None:
+        return r
+    url = link.split('?')[0] + '?seite=all'
+    b, encoding = get_resource(url, session)
+    write_cached(cache, i, ident, b, encoding)
+    return (b, encoding)
+
+# For the pre-scan, i.e. comments and script/style blocks are matched
+# such that any markup inside them is skipped.
+prescan_re = re.compile(rb'<!--.*?-->|<(script|style)\b.*?</\1\s*>'
+        rb'|(<article\b[^>]*>)|(<div\b[^>]*>)|(<meta\b[^>]*>)', re.S | re.I)
+meldung_re = re.compile(rb'\sid\s*=\s*(?:"meldung"|\'meldung\'|meldung[\s/>])',
+                        re.I)
+article_page_re = re.compile(rb'\sclass\s*=\s*(?:"[^"]*|\'[^\']*|[^\s>]*)article_page',
+                             re.I)
+author_meta_re = re.compile(rb'\sname\s*=\s*["\']?author\b', re.I)
+# i.e. also matches the content attribute of a http-equiv Content-Type
+# meta, but not other http-equiv metas like X-UA-Compatible
+charset_meta_re = re.compile(rb'charset\s*=', re.I)
+doctype_re = re.compile(rb'\s*<!DOCTYPE[^>]*>', re.I)
+end_tag_res = {
+    b'article': re.compile(rb'<!--.*?-->|<(script|style)\b.*?</\1\s*>'
+                           rb'|<(/?)article\b[^>]*>', re.S | re.I),
+    b'div':     re.compile(rb'<!--.*?-->|<(script|style)\b.*?</\1\s*>'
+                           rb'|<(/?)div\b[^>]*>', re.S | re.I)
+}
+
+def find_region_end(b, tag, off):
+    depth = 1
+    for m in end_tag_res[tag].finditer(b, off):
+        if m.group(2) is None:
+            continue
+        depth += -1 if m.group(2) else 1
+        if depth == 0:
+            return m.end()
+    return None
+
+# Locate the region find_article() is looking for (plus the meta
+# tags extract_article() needs) in the raw page and wrap it in a
+# minimal document. Thus, html5lib only needs to parse a fraction of
+# the page, i.e. not the navigation, footers, inline scripts etc.
+#
+# Returns None if the region can't be located unambiguously.
+def prescan_article(b):
+    metas = []
+    charset = b''
+    start = None
+    for m in prescan_re.finditer(b):
+        if m.group(2) and meldung_re.search(m.group(2)):
+            start, tag = m, b'article'
+            break
+        if m.group(3) and article_page_re.search(m.group(3)):
+            start, tag = m, b'div'
+            break
+        if m.group(4):
+            if author_meta_re.search(m.group(4)):
+                metas.append(m.group(4))
+            elif not charset and charset_meta_re.search(m.group(4)):
+                charset = m.group(4)
+    if start is None:
+        return None
+    end = find_region_end(b, tag, start.end())
+    if end is None:
+        return None
+    after = [ m.group(4) for m in prescan_re.finditer(b, end)
+              if m.group(4) and author_meta_re.search(m.group(4)) ]
+    d = doctype_re.match(b)
+    return b''.join([ d.group(0) if d else b'', b'<html><head>', charset ]
+                    + metas + [ b'</head><body>', b[start.start():end] ]
+                    + after + [ b'</body></html>' ])
+
+def test_prescan_article():
+    inp = b'''<!DOCTYPE html><html><head><meta charset="utf-8">
+<meta name="author" content="A"><script>x = '<div class="article_page">';</script>
+</head><body><nav>n</nav><!-- <article id="meldung"> -->
+<article id="meldung"><div>a<script>"</article>"</script></div><p>b</article>
+<footer>f</footer><meta name="author" content="B"></body></html>'''
+    x = prescan_article(inp)
+    assert x == (b'<!DOCTYPE html><html><head><meta charset="utf-8">'
+                 b'<meta name="author" content="A"></head><body>'
+                 b'<article id="meldung"><div>a<script>"</article>"</script></div>'
+                 b'<p>b</article><meta name="author" content="B"></body></html>')
+    inp = '''<html><head><meta http-equiv="X-UA-Compatible" content="IE=edge">
+<meta charset="utf-8"></head><body><article id="meldung"><p>Grüße</p>
+</article></body></html>'''.encode()
+    x = prescan_article(inp)
+    assert x == ('<html><head><meta charset="utf-8"></head><body>'
+                 '<article id="meldung"><p>Grüße</p>\n</article>'
+                 '</body></html>').encode()
+    d = html5lib.parse(x, transport_encoding=None)
+    assert ''.join(d.itertext()) == 'Grüße\n'
+    x = prescan_article(b'<meta http-equiv="Content-Type" content="text/html;'
+                        b'charset=utf-8"><article id="meldung"></article>')
+    assert b'charset=utf-8' in x
+    assert prescan_article(b'<div class="x article_page"><div>a</div>') is None
+    assert prescan_article(b'<article id="meldung2"></article>') is None
 
 def parse_article(link, ident, cache, session):
-    o = get_article(link, ident, cache, session)
-    return html5lib.parse(o)
+    b, encoding = get_article(link, ident, cache, session)
+    x = prescan_article(b)
+    if x is None:
+        log.debug('Pre-scan failed, parsing the complete page of: ' + ident)
+        x = b
+    # i.e. without a declared encoding, html5lib does its own sniffing
+    return html5lib.parse(x, transport_encoding=encoding)
 
 
 def stack_iter(element, tag=None):
@@ -118,92 +532,86 @@ def stack_iter(element, tag=None):
                 yield (e, es)
             es.append(None)
 
-def oneof_in(qs, t):
-    for q in qs:
-        if q in t:
-            return True
-    return False
-
-# and facebook/twitter/... share boilerplate
-# and static ads
-# and custom tags
-def remove_script(a):
-    l = []
-    for e, stack in stack_iter(a):
-        if e.tag in (xns+'script', xns+'noscript'):
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'div' and 'shariff' in e.get('class', ''):
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'div' and 'creator' in e.get('class', ''):
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'footer':
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'div' and 'footer' in e.get('class', ''):
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'header':
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'p' and 'article_page_category' in e.get('class', ''):
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'ul' and 'article_page_info' in e.get('class', ''):
-            l.append( (stack[-2], e) )
-        # i.e. match double-click ads <html:aside class="teaser ad-microsites">
-        # and similar
-        elif (e.tag in (xns+'div', xns+'aside')
-                and oneof_in(('-ad-container', 'img-ad', 'teaser', 'newsletter-subscription'), e.get('class', '')) ):
-            l.append( (stack[-2], e) )
-        elif e.tag == xns+'div' and '-ad-' in e.get('id', ''):
-            l.append( (stack[-2], e) )
-        elif str(e.tag).startswith(xns+'a-'):
-            if e.tag == xns+'a-img':
-                e.tag = xns+'img'
+# Remove all (parent, node) pairs in linear time, i.e. each affected
+# parent's children list is rebuilt once - whereas calling
+# parent.remove() for each node is quadratic, since remove() is a
+# linear search. In contrast to remove(), the tail text of a
+# removed node is preserved.
+def prune(pairs):
+    h = {}
+    for parent, node in pairs:
+        h.setdefault(id(parent), (parent, set()))[1].add(id(node))
+    for parent, ids in h.values():
+        ys = []
+        ts = []
+        def attach_tails():
+            t = ''.join(ts)
+            ts.clear()
+            if ys:
+                ys[-1].tail = (ys[-1].tail or '') + t
             else:
-                l.append( (stack[-2], e) )
-        elif e.tag == xns+'a' and 'a-button' in e.get('class', ''):
-            l.append( (stack[-2], e) )
-        # i.e. match class="ad-microsites__item" or
-        # <html:aside class="us-ad">
-        elif e.get('class', '').startswith('ad-') or e.get('class', '').endswith('-ad'):
-            l.append( (stack[-2], e) )
-    for parent, node in l:
-        parent.remove(node)
-
-def remove_entries(d, expr):
-    if not expr:
-        return
-    ex = re.compile(expr)
-    l = []
-    log.debug('Filtering titles ...')
-    for e, stack in stack_iter(d):
-        if e.tag == ans+'entry':
-            t = e.find(ans+'title')
-            if ex.match(t.text):
-                log.debug('Removing entry because of its title: {}'.format(t.text))
-                l.append( (stack[-2], e) )
-    for parent, node in l:
-        parent.remove(node)
-
-def update_urls(a, base):
-    def f(e, att):
-        href = e.get(att)
-        if not href:
-            return
-        if href.startswith('//'):
-            e.set(att, 'https:' + href)
-        elif href.startswith('/'):
-            e.set(att, base + href)
-
-    for e in a.iter():
-        if e.tag == xns+'a':
-            att = 'href'
-        elif e.tag == xns+'img' or e.tag == 'iframe':
-            att = 'src'
-        else:
-            continue
-        f(e, att)
-
-
-def str_contains(s, xs):
-    return any(x in s for x in xs)
+                parent.text = (parent.text or '') + t
+        for e in parent:
+            if id(e) in ids:
+                if e.tail:
+                    ts.append(e.tail)
+            else:
+                if ts:
+                    attach_tails()
+                ys.append(e)
+        if ts:
+            attach_tails()
+        parent[:] = ys
+
+def test_prune():
+    d = ET.fromstring('<r>a<x/>b<y/>c<z/>d<w/>e</r>')
+    xs = list(d)
+    prune([ (d, xs[0]), (d, xs[2]), (d, xs[3]) ])
+    assert ET.tostring(d) == b'<r>ab<y />cde</r>'
+    prune([ (d, d[0]) ])
+    assert ET.tostring(d) == b'<r>abcde</r>'
+
+# Cleanup rules for the article content, i.e. for removing
+# facebook/twitter/... share boilerplate, static ads and custom tags.
+#
+# Each rule is a tuple of: tag, attribute, pattern, action
+#
+# where the pattern is a regular expression that is searched in the
+# attribute value and the action is either None (i.e. drop the element)
+# or a new tag name. A rule without attribute matches unconditionally.
+# The tag 'a-*' matches all custom a- tags and the '*' rules apply to
+# all tags. For each element, the first matching rule wins.
+clean_rules = [
+    ( 'script',   None,    None,                      None  ),
+    ( 'noscript', None,    None,                      None  ),
+    ( 'header',   None,    None,                      None  ),
+    ( 'footer',   None,    None,                      None  ),
+    ( 'div',      'class', 'shariff',                 None  ),
+    ( 'div',      'class', 'creator',                 None  ),
+    ( 'div',      'class', 'footer',                  None  ),
+    ( 'p',        'class', 'article_page_category',   None  ),
+    ( 'ul',       'class', 'article_page_info',       None  ),
+    # i.e. match double-click ads <html:aside class="teaser ad-microsites">
+    # and similar
+    ( 'div',      'class', '-ad-container',           None  ),
+    ( 'div',      'class', 'img-ad',                  None  ),
+    ( 'div',      'class', 'teaser',                  None  ),
+    ( 'div',      'class', 'newsletter-subscription', None  ),
+    ( 'aside',    'class', '-ad-container',           None  ),
+    ( 'aside',    'class', 'img-ad',                  None  ),
+    ( 'aside',    'class', 'teaser',                  None  ),
+    ( 'aside',    'class', 'newsletter-subscription', None  ),
+    ( 'div',      'id',    '-ad-',                    None  ),
+    ( 'a-img',    None,    None,                      'img' ),
+    ( 'a-*',      None,    None,                      None  ),
+    ( 'a',        'class', 'a-button',                None  ),
+    # i.e. match class="ad-microsites__item" or
+    # <html:aside class="us-ad">
+    ( '*',        'class', '^ad-|-ad$',               None  ),
+]
+
+# attributes that contain URLs which are made absolute
+url_attributes = { xns+'a': 'href', xns+'img': 'src', xns+'iframe': 'src' }
 
 # work around html5lib parses that contain invalid characters
 # in attribute names. Example HTML input:
@@ -211,24 +619,147 @@ def str_contains(s, xs):
 #   title="Mehr zum Feuilleton "Missing Link"">
 #     Mehr zum Feuilleton "Missing Link"
 #   </a>
-def fix_attributes(a):
-    for e in a.iter():
-        ks = []
-        for k, v in e.attrib.items():
-            if str_contains(k, ('"', ',', '!', '?', '-')):
-                ks.append(k)
-        for k in ks:
-            e.attrib.pop(k)
-
-def fix_xmlns(a):
-    for e in a.iter():
-        xs = []
-        for k, v in e.attrib.items():
-            if k == xmlns + 'xmlns':
-                xs.append((k, v))
-        for k, v in xs:
-            e.attrib.pop(k)
-            a.attrib['xmlns'] = v
+bad_attribute_re = re.compile('[",!?-]')
+
+# Compile the rules into: namespaced tag -> tuple of (attribute, regex, action)
+# where consecutive patterns of the same attribute and action are merged
+# into one regex, such that each element is checked with a dictionary
+# lookup plus at most a few regex searches.
+def compile_clean_rules(rules):
+    h = {}
+    for tag, att, pat, action in rules:
+        xs = h.setdefault(tag, [])
+        if att and xs and xs[-1][0] == att and xs[-1][2] == action:
+            xs[-1][1].append(pat)
+        else:
+            xs.append( (att, [pat] if pat else None, action) )
+    def mk(xs):
+        return tuple( (att, re.compile('|'.join(pats)) if pats else None, action)
+                      for att, pats, action in xs )
+    generic = h.pop('*', [])
+    r = {}
+    for tag, xs in h.items():
+        r[tag if tag.endswith('*') else xns+tag] = mk(xs + generic)
+    r['*'] = mk(generic)
+    return r
+
+compiled_clean_rules = compile_clean_rules(clean_rules)
+
+def match_clean_rules(e, rules=compiled_clean_rules):
+    tag = e.tag
+    rs = rules.get(tag)
+    if rs is None:
+        if type(tag) is str and tag.startswith(xns+'a-'):
+            rs = rules['a-*']
+        else:
+            rs = rules['*']
+    for att, ex, action in rs:
+        if att is None:
+            return (True, action)
+        v = e.get(att)
+        if v and ex.search(v):
+            return (True, action)
+    return (False, None)
+
+def clean_attributes(e, root, base):
+    att = url_attributes.get(e.tag)
+    if att:
+        href = e.get(att)
+        if href:
+            if href.startswith('//'):
+                e.set(att, 'https:' + href)
+            elif href.startswith('/'):
+                e.set(att, base + href)
+    ks = [ k for k in e.attrib if bad_attribute_re.search(k) or k == xmlns+'xmlns' ]
+    for k in ks:
+        v = e.attrib.pop(k)
+        if k == xmlns+'xmlns':
+            root.attrib['xmlns'] = v
+
+# Clean the article in a single pass, i.e. apply the clean_rules,
+# make URLs absolute, remove invalid attributes and move
+# xmlns attributes to the article element.
+def clean_article(a, base):
+    l = []
+    clean_attributes(a, a, base)
+    stack = [ iter(a) ]
+    parents = [ a ]
+    while stack:
+        e = next(stack[-1], None)
+        if e is None:
+            stack.pop()
+            parents.pop()
+            continue
+        matched, action = match_clean_rules(e)
+        if matched:
+            if action is None:
+                l.append( (parents[-1], e) )
+                continue
+            e.tag = xns+action
+        clean_attributes(e, a, base)
+        stack.append(iter(e))
+        parents.append(e)
+    prune(l)
+
+def test_clean_article():
+    inp = '''<article id="meldung"><header>h</header>
+<p class="article_page_category">c</p><p>Text <a href="/foo">foo</a>
+<a-img src="//example.org/x.jpg"></a-img><a-foo>bar</a-foo>
+<a class="a-button" href="/b">b</a></p>
+<div class="teaser"><script>x</script></div><div id="x-ad-1">a</div>
+<aside class="us-ad">u</aside><span class="ad-item">i</span>
+<div class="x" data-y="1" title="Mehr zum "Missing-Link"">ok</div>
+</article>'''
+    d = html5lib.parse(inp)
+    a = find_article(d)
+    clean_article(a, 'https://www.heise.de')
+    tags = [ e.tag[len(xns):] for e in a.iter() if e.tag.startswith(xns) ]
+    assert tags == ['article', 'p', 'a', 'img', 'div']
+    assert a.find(xns+'p/'+xns+'a').get('href') == 'https://www.heise.de/foo'
+    assert a.find(xns+'p/'+xns+'img').get('src') == 'https://example.org/x.jpg'
+    assert sorted(a.find(xns+'div').attrib.keys()) == ['class', 'title']
+
+# entry predicates - each returns the reason for removing an entry
+# or None for keeping it
+def title_filter(expr):
+    ex = re.compile(expr)
+    def f(entry):
+        t = entry.find(ans+'title')
+        if t is not None and t.text and ex.match(t.text):
+            return 'its title: {}'.format(t.text)
+        return None
+    return f
+
+def link_filter(s, what):
+    def f(entry):
+        link = entry.find(ans + 'link')
+        href = link.get('href', '') if link is not None else ''
+        if s in href:
+            return '{}: {}'.format(what, href)
+        return None
+    return f
+
+def mk_entry_filters(expr):
+    fs = [ link_filter('/bestenlisten/', 'TechStage') ]
+    if expr:
+        fs.append(title_filter(expr))
+    return fs
+
+# NB: must be called before replace_content() such that filtered
+# entries don't cost any network or parse work
+def remove_entries(d, filters):
+    l = []
+    log.debug('Filtering entries ...')
+    for e, stack in stack_iter(d):
+        if e.tag != ans+'entry':
+            continue
+        for f in filters:
+            reason = f(e)
+            if reason:
+                log.debug('Removing entry because of {}'.format(reason))
+                l.append( (stack[-2], e) )
+                break
+    prune(l)
 
 class No_Article_Error(Exception):
     pass
@@ -241,82 +772,240 @@ def find_article(root):
             return a
     raise No_Article_Error("Couldn't find any article element")
 
+# Bump this version whenever the cleanup rules (i.e. clean_rules
+# etc.) change, such that already cleaned articles are invalidated.
+clean_version = 3
+
+def clean_name(ident):
+    i = san_re.sub('_', ident)
+    return '{}.clean.heiser'.format(i)
+
+def load_clean_article(cache, ident):
+    name = clean_name(ident)
+    if name not in cache:
+        return None
+    filename = cache.path(name)
+    try:
+        c = ET.parse(filename).getroot()
+    except FileNotFoundError:
+        log.warning('Cached file vanished: ' + filename)
+        cache.discard(name)
+        return None
+    except ET.ParseError as e:
+        log.warning('Ignoring broken cached article {}: {}'.format(filename, e))
+        return None
+    if c.get('version') != str(clean_version) or len(c) != 1:
+        log.debug('Ignoring outdated cached article: ' + filename)
+        return None
+    log.debug('Found cleaned ID {} under {}'.format(ident, cache))
+    a = c[0]
+    # cf. clean_attributes()
+    ns = c.get('article-xmlns')
+    if ns is not None:
+        a.set('xmlns', ns)
+    return (a, c.get('author', ''))
+
+def store_clean_article(cache, ident, a, author):
+    name = clean_name(ident)
+    filename = cache.path(name)
+    c = ET.Element('heiser', version=str(clean_version), author=author)
+    # otherwise the attribute would turn into a namespace declaration
+    # when parsing the file again
+    ns = a.attrib.pop('xmlns', None)
+    if ns is not None:
+        c.set('article-xmlns', ns)
+    c.append(a)
+    try:
+        s = ET.tostring(c, encoding='utf-8')
+    finally:
+        if ns is not None:
+            a.set('xmlns', ns)
+    tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(s)
+    os.replace(tmp, filename)
+    cache.add(name, ident, len(s))
+
 def extract_article(link, ident, cache, session):
+    r = load_clean_article(cache, ident)
+    if r:
+        return r
     root = parse_article(link, ident, cache, session)
     author = ', '.join([ e.get('content')
         for e in root.iter(tag=xns+'meta') if e.get('name') == 'author'])
     a = find_article(root)
-    remove_script(a)
     i = link.index('//')
     prefix = link[:link.index('/', i+2)]
-    update_urls(a, prefix)
-    fix_attributes(a)
-    fix_xmlns(a)
+    clean_article(a, prefix)
+    store_clean_article(cache, ident, a, author)
     return (a, author)
 
-def replace_content(root, session, cache='./cache'):
-    xs = []
-    for entry, stack in stack_iter(root):
-        if entry.tag != ans+'entry':
+def insert_article(entry, article, author_s):
+    old_content = entry.find(ans + 'content')
+    i = list(entry).index(old_content)
+    entry.remove(old_content)
+    content = ET.Element(ans + 'content')
+    content.set('type', 'xhtml')
+    content.append(article)
+    entry.insert(i, content)
+
+    author = ET.Element(ans + 'author')
+    author_name = ET.SubElement(author, ans + 'name')
+    author_name.text = author_s
+    entry.insert(i, author)
+
+def try_extract_article(href, ident, cache, session):
+    log.debug('Inserting {} (ID: {})'.format(href, ident))
+    try:
+        return extract_article(href, ident, cache, session)
+    except No_Article_Error as e:
+        log.debug('Not modifying entry: {}'.format(e))
+    except requests.exceptions.HTTPError as e:
+        log.debug('Not modifying entry due to HTTP error: {}'.format(e))
+    return None
+
+# Index the augmented entries of a previously written output feed,
+# i.e. ID -> (article, author)
+def load_previous_entries(filename):
+    h = {}
+    if not os.path.exists(filename):
+        return h
+    log.debug('Loading previous entries from: ' + filename)
+    ns = []
+    try:
+        it = ET.iterparse(filename, events=('start-ns', 'start'))
+        for ev, x in it:
+            if ev == 'start-ns':
+                ns.append(x)
+                continue
+            # restore the xmlns attribute that was moved there by
+            # clean_attributes() and thus was written as namespace
+            # declaration
+            for prefix, uri in ns:
+                if prefix == '':
+                    x.set('xmlns', uri)
+            ns.clear()
+    except ET.ParseError as e:
+        log.warning('Ignoring broken previous output {}: {}'.format(filename, e))
+        return h
+    for entry in it.root.iter(ans + 'entry'):
+        ident = entry.find(ans + 'id')
+        content = entry.find(ans + 'content')
+        name = entry.find(ans + 'author/' + ans + 'name')
+        # i.e. skip entries where the article extraction failed
+        if (ident is None or content is None or name is None
+                or content.get('type') != 'xhtml' or len(content) != 1):
             continue
+        h[ident.text] = (content[0], name.text or '')
+    log.debug('Found {} previous entries'.format(len(h)))
+    return h
+
+# articles is an optional dict (ID -> result of try_extract_article())
+# that is shared between multiple feeds, such that articles that
+# are cross-posted are only extracted once
+def replace_content(root, session, cache, jobs=1, previous=None,
+                    articles=None):
+    previous = previous or {}
+    if articles is None:
+        articles = {}
+    ys = []
+    for entry in root.iter(ans + 'entry'):
         link = entry.find(ans + 'link')
         href = link.get('href')
         ident = entry.find(ans + 'id')
-        if '/bestenlisten/' in href:
-            log.debug(f'Removing {href} because TechStage')
-            xs.append( (stack[-2], entry) )
-            continue
-        log.debug('Inserting {} (ID: {})'.format(href, ident.text))
-        try:
-            (article, author_s) = extract_article(href, ident.text, cache, session)
-        except No_Article_Error as e:
-            log.debug('Not modifying entry: {}'.format(e))
+        if ident.text in previous:
+            log.debug('Reusing previous entry: {}'.format(ident.text))
+            insert_article(entry, *previous[ident.text])
             continue
-        except requests.exceptions.HTTPError as e:
-            log.debug('Not modifying entry due to HTTP error: {}'.format(e))
+        if ident.text in articles:
+            log.debug('Reusing already extracted article: {}'.format(ident.text))
+            r = articles[ident.text]
+            if r is not None:
+                insert_article(entry, copy.deepcopy(r[0]), r[1])
             continue
-
-        old_content = entry.find(ans + 'content')
-        i = list(entry).index(old_content)
-        entry.remove(old_content)
-        content = ET.Element(ans + 'content')
-        content.set('type', 'xhtml')
-        content.append(article)
-        entry.insert(i, content)
-
-        author = ET.Element(ans + 'author')
-        author_name = ET.SubElement(author, ans + 'name')
-        author_name.text = author_s
-        entry.insert(i, author)
-    for parent, e in xs:
-        parent.remove(e)
+        ys.append( (entry, href, ident.text) )
+
+    def f(y):
+        _, href, ident = y
+        return try_extract_article(href, ident, cache, session)
+
+    # NB: Executor.map() yields the results in the order of its input,
+    # thus the articles are spliced back in the original entry order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as ex:
+        rs = ex.map(f, ys) if jobs > 1 else map(f, ys)
+        for (entry, _, ident), r in zip(ys, rs):
+            articles[ident] = r
+            if r is None:
+                continue
+            insert_article(entry, *r)
 
 def clean_cache(cache, protected_days=7):
-    for fn in os.listdir(cache):
-        if fn.endswith('.heiser'):
-            filename = '{}/{}'.format(cache, fn)
-            delta = (calendar.timegm(time.gmtime())
-                - os.path.getmtime(filename) ) / 3600 / 24
-            if delta > protected_days:
-                log.debug('Removing cached item: ' + filename)
-                os.remove(filename)
+    t = calendar.timegm(time.gmtime()) - protected_days * 24 * 3600
+    cache.expire(t)
+
+def load_jobs(args):
+    if not args.feeds:
+        return [ { 'url': args.feed_url, 'file': args.feed,
+                   'output': args.output, 'filter': args.filter } ]
+    with open(args.feeds, 'rb') as f:
+        feeds = tomllib.load(f)
+    return [ { 'url': feed['url'], 'file': None, 'output': feed['output'],
+               'filter': feed.get('filter', args.filter) }
+             for feed in feeds['feed'] ]
+
+# returns (tree, validators) or None if the feed is unchanged
+def load_feed(job, args, session, state):
+    if job['file']:
+        log.debug('Reading news feed from file: ' + job['file'])
+        return (ET.parse(job['file']), {})
+    # the validators are useless when the previous output is gone
+    if args.force or not os.path.exists(job['output']):
+        validators = {}
+    else:
+        validators = state.get(os.path.abspath(job['output']), {})
+    s, validators = get_modified_resource(job['url'], session, validators)
+    if s is None:
+        log.info('Feed not modified since the last run: ' + job['url'])
+        return None
+    return (ET.ElementTree(ET.fromstring(s)), validators)
 
 def main():
     setup_logging()
     args = parse_args()
     os.makedirs(args.cache, exist_ok=True)
-    clean_cache(args.cache)
-    session = requests.Session()
-    if args.feed:
-        log.debug('Reading news feed from file: ' + args.feed)
-        d = ET.parse(args.feed)
-    else:
-        d = ET.ElementTree(ET.fromstring(get_resource(args.feed_url, session)))
-    replace_content(d.getroot(), session, cache=args.cache)
-    remove_entries(d.getroot(), args.filter)
-    ET.indent(d, space='    ')
-    log.info('Writing augmented feed to: ' + args.output)
-    d.write(args.output)
+    global host_limit
+    host_limit = args.host_jobs
+    session = mk_session(args.jobs)
+    state = load_state(args.cache)
+    cache = None
+    # i.e. the rebuild must not depend on some feed having changed,
+    # whereas normal runs only load the index when it's needed
+    if args.rebuild_cache_index:
+        cache = Cache_Index(args.cache)
+        cache.rebuild()
+        clean_cache(cache)
+    articles = {}
+    for job in load_jobs(args):
+        r = load_feed(job, args, session, state)
+        if r is None:
+            continue
+        d, validators = r
+        if cache is None:
+            cache = Cache_Index(args.cache)
+            clean_cache(cache)
+        key = os.path.abspath(job['output'])
+        remove_entries(d.getroot(), mk_entry_filters(job['filter']))
+        previous = {}
+        # i.e. only reuse entries that were cleaned with the current rules
+        if args.incremental and state.get(key, {}).get('version') == clean_version:
+            previous = load_previous_entries(job['output'])
+        replace_content(d.getroot(), session, cache=cache, jobs=args.jobs,
+                        previous=previous, articles=articles)
+        ET.indent(d, space='    ')
+        log.info('Writing augmented feed to: ' + job['output'])
+        d.write(job['output'])
+        state[key] = dict(validators, version=clean_version)
+        update_state(args.cache, key, state[key])
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -5,9 +5,11 @@
 
 import argparse
 import calendar
+import concurrent.futures
 import datetime
 import hashlib
 import html5lib
+import json
 import logging
 import os
 import re
@@ -50,6 +52,16 @@ def mk_arg_parser():
                    metavar='URL', help='start url')
     p.add_argument('-n', default=3, type=int,
                    help='how many index pages to fetch')
+    p.add_argument('--jobs', '-j', default=1, type=int, metavar='N',
+                   help='fetch up to N index pages in parallel, i.e. by'
+                   ' predicting their offsets (default: %(default)s)')
+
+    p.add_argument('--incremental', '-i', action='store_true',
+                   help='stop paging at index pages that only contain'
+                   ' articles of the previous output and reuse its entries')
+    p.add_argument('--procs', '-p', default=1, type=int, metavar='N',
+                   help='parse article pages in N worker processes'
+                   ' (default: %(default)s)')
 
     p.add_argument('input', metavar='FILE', nargs='*',
                    help='alternative to --url - when files are already loaded')
@@ -147,11 +159,16 @@ def parse_headlines_f(filename):
 # shared with heiser.py
 
 
-def get_resource(url, session):
+def get_response(url, session, headers=None):
     log.debug('Getting: {}'.format(url))
-    r = session.get(url)
-    r.raise_for_status()
-    return r.text
+    r = session.get(url, headers=headers)
+    if r.status_code != 304:
+        r.raise_for_status()
+    return r
+
+
+def get_resource(url, session):
+    return get_response(url, session).text
 
 # shared with heiser.py
 
@@ -169,20 +186,60 @@ def clean_cache(cache, protected_days=7):
 
 san_re = re.compile('[^A-Za-z0-9_-]')
 
-# shared with heiser.py
+# i.e. the page of a still embargoed article
+stub_re = re.compile('is currently available to LWN subscribers only'
+                     '|Subscription required')
+
+
+def meta_filename(filename):
+    return filename + '.meta'
 
 
+def load_article_meta(filename):
+    try:
+        with open(meta_filename(filename)) as f:
+            m = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return m if isinstance(m, dict) else None
+
+
+def store_article_meta(filename, r, s):
+    m = {'etag': r.headers.get('ETag'),
+         'modified': r.headers.get('Last-Modified'),
+         'stub': stub_re.search(s) is not None}
+    tmp = meta_filename(filename) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(m, f)
+    os.replace(tmp, meta_filename(filename))
+
+
+# Cached pages are used as-is, unless they are subscriber-only stubs.
+# Those are revalidated with a conditional GET, such that they are
+# replaced as soon as the article is de-embargoed.
 def get_article(link, ident, cache, session):
     i = san_re.sub('_', ident)
     filename = '{}/{}'.format(cache, i)
+    headers = {}
     if os.path.exists(filename):
-        log.debug('Found ID {} under {}'.format(ident, cache))
+        m = load_article_meta(filename)
+        if not m or not m.get('stub'):
+            log.debug('Found ID {} under {}'.format(ident, cache))
+            return open(filename, 'r')
+        log.debug('Revalidating subscriber-only stub {}'.format(filename))
+        if m.get('etag'):
+            headers['If-None-Match'] = m['etag']
+        if m.get('modified'):
+            headers['If-Modified-Since'] = m['modified']
+    r = get_response(link, session, headers)
+    if r.status_code == 304:
+        log.debug('Stub {} is unchanged'.format(filename))
         return open(filename, 'r')
-    else:
-        s = get_resource(link, session)
-        with open(filename, 'w') as f:
-            f.write(s)
-        return s
+    s = r.text
+    with open(filename, 'w') as f:
+        f.write(s)
+    store_article_meta(filename, r, s)
+    return s
 
 # shared with heiser.py
 
@@ -210,20 +267,50 @@ def update_urls(a, base):
 
 
 def gen_id(e):
-    h = hashlib.sha256()
+    # NB: hashes the same byte sequence as feeding each tag, text and sorted
+    # attribute pair to h.update() one by one, i.e. the IDs are unchanged,
+    # since UTF-8 encoding commutes with concatenation
+    updated_tag = ans + 'updated'
+    xs = []
     for x in e.iter():
-        if x.tag == ans + 'updated':
-            continue
-        if type(x.tag) is not str:
+        tag = x.tag
+        if tag == updated_tag or type(tag) is not str:
             continue
-        h.update(bytes(x.tag, encoding='utf8'))
+        xs.append(tag)
         if x.text:
-            h.update(bytes(x.text, encoding='utf8'))
-        for k, v in sorted(x.items()):
-            h.update(bytes(k, encoding='utf8'))
-            h.update(bytes(v, encoding='utf8'))
-    hex = h.hexdigest()
-    return 'urn:sha256:' + hex
+            xs.append(x.text)
+        if x.attrib:
+            for k, v in sorted(x.attrib.items()):
+                xs.append(k)
+                xs.append(v)
+    h = hashlib.sha256(''.join(xs).encode('utf8'))
+    return 'urn:sha256:' + h.hexdigest()
+
+
+def test_gen_id():
+    def ref_id(e):
+        h = hashlib.sha256()
+        for x in e.iter():
+            if x.tag == ans + 'updated':
+                continue
+            if type(x.tag) is not str:
+                continue
+            h.update(bytes(x.tag, encoding='utf8'))
+            if x.text:
+                h.update(bytes(x.text, encoding='utf8'))
+            for k, v in sorted(x.items()):
+                h.update(bytes(k, encoding='utf8'))
+                h.update(bytes(v, encoding='utf8'))
+        return 'urn:sha256:' + h.hexdigest()
+    d = html5lib.parse('<p class="x" id="\u00e4">Gr\u00fc\u00dfe <!-- c --><b>\u2013'
+                       '</b> <a title="t" href="/a">\U0001f600</a></p>')
+    entry = ET.Element(ans + 'entry')
+    ET.SubElement(entry, ans + 'title').text = 'T\u00eftle'
+    entry.append(updated(3))
+    ET.SubElement(entry, ans + 'content').append(d)
+    assert gen_id(entry) == ref_id(entry)
+    assert gen_id(ET.Element(ans + 'entry')) == ref_id(ET.Element(ans + 'entry'))
+
 
 now = datetime.datetime.now(datetime.UTC)
 
@@ -246,7 +333,9 @@ def mk_entry(row, off):
     content = ET.SubElement(entry, ans + 'content')
     content.set('type', 'xhtml')
     content.append(row[1])
-    ET.SubElement(entry, ans + 'id').text = gen_id(entry)
+    # i.e. reused rows keep their previous ID, as gen_id() would yield a
+    # different one for their already sanitized and indented content
+    ET.SubElement(entry, ans + 'id').text = row[3] if len(row) > 3 else gen_id(entry)
     return entry
 
 
@@ -326,18 +415,137 @@ title="Julien Desfossez, Vineeth Remanan Pillai", class="lthumb"></a>
     assert sorted(a.attrib.keys()) == ['alt', 'class', 'src', 'title']
 
 
+def extract_article_text(s):
+    d = html5lib.parse(s, default_treebuilder)
+    divs = d.findall('.//' + xns + 'div[@class="ArticleText"]')
+    if not divs:
+        return None
+    x = divs[0]
+    remove_header(x)
+    remove_comments(x)
+    return x
+
+
+# Attributes names that aren't plain NCNames (i.e. html5lib artifacts such
+# as '<p' or 'mobile"' and namespaced ones) are hex-encoded into this
+# namespace, for the transfer between processes. They must survive
+# unchanged until sanitize_tree(), since gen_id() hashes them, as well.
+enc_att_ns = '{urn:x-lwn-py:attribute}'
+plain_att_re = re.compile('^[A-Za-z_][A-Za-z0-9_.-]*$')
+
+
+def encode_attributes(x):
+    for e in x.iter():
+        if all(plain_att_re.match(k) for k in e.attrib):
+            continue
+        xs = [(k if plain_att_re.match(k)
+               else enc_att_ns + 'a' + k.encode('utf8').hex(), v)
+              for k, v in e.attrib.items()]
+        e.attrib.clear()
+        e.attrib.update(xs)
+
+
+def decode_attributes(x):
+    n = len(enc_att_ns)
+    for e in x.iter():
+        if not any(k.startswith(enc_att_ns) for k in e.attrib):
+            continue
+        xs = [(bytes.fromhex(k[n + 1:]).decode('utf8')
+               if k.startswith(enc_att_ns) else k, v)
+              for k, v in e.attrib.items()]
+        e.attrib.clear()
+        e.attrib.update(xs)
+
+
+# Runs in a worker process, i.e. returns the article as compact XHTML
+# bytes (plus its tail) instead of a pickled element tree.
+# Returns False if the article doesn't survive an XML round trip, and
+# thus needs to be extracted in the main process.
+def extract_article_xhtml(s):
+    x = extract_article_text(s)
+    if x is None:
+        return None
+    encode_attributes(x)
+    tail = x.tail
+    x.tail = None
+    b = ET.tostring(x, encoding='utf-8')
+    # i.e. the XML parser would normalize it into a newline
+    if b'\r' in b:
+        return False
+    return (b, tail)
+
+
+def parse_article_xhtml(b, tail):
+    p = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True,
+                                           insert_pis=True))
+    p.feed(b)
+    x = p.close()
+    decode_attributes(x)
+    x.tail = tail
+    return x
+
+
+def test_article_xhtml():
+    inp = '''<div class="ArticleText"><center><table></table></center>
+<a href="/Articles/718632/"</a>this article</a> <br clear="all"
+<p> <img src="x.png" alt="[Slide: "Classical freedoms"]" class="photo"/>
+<!-- comment --></div> tail'''
+    x = extract_article_text(inp)
+    y = extract_article_text(inp)
+    b, tail = extract_article_xhtml(inp)
+    z = parse_article_xhtml(b, tail)
+    assert ET.tostring(z) == ET.tostring(x)
+    assert gen_id(z) == gen_id(x)
+    sanitize_tree(y)
+    sanitize_tree(z)
+    assert ET.tostring(z) == ET.tostring(y)
+
+
+def read_article(a):
+    if isinstance(a, str):
+        return a
+    with a:
+        return a.read()
+
+
 def resolve_articles(rs, args, session):
+    if args.procs > 1:
+        return resolve_articles_parallel(rs, args, session)
     for r in rs:
-        if not r[2]:
+        # i.e. skip rows without link or reused ones
+        if not r[2] or len(r) > 3:
             continue
         link = 'https://lwn.net' + r[2]
         a = get_article(link, link, args.cache, session)
-        d = html5lib.parse(a, default_treebuilder)
-        divs = d.findall('.//' + xns + 'div[@class="ArticleText"]')
-        if divs:
-            x = divs[0]
-            remove_header(x)
-            remove_comments(x)
+        x = extract_article_text(a)
+        if x is not None:
+            r[1] = x
+
+
+# i.e. the pages are parsed in worker processes while the main process
+# continues fetching the next ones
+def resolve_articles_parallel(rs, args, session):
+    xs = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.procs) as ex:
+        for r in rs:
+            if not r[2] or len(r) > 3:
+                continue
+            link = 'https://lwn.net' + r[2]
+            s = read_article(get_article(link, link, args.cache, session))
+            xs.append((r, s, ex.submit(extract_article_xhtml, s)))
+        for r, s, f in xs:
+            y = f.result()
+            if y is None:
+                continue
+            x = None
+            if y:
+                try:
+                    x = parse_article_xhtml(*y)
+                except ET.ParseError as e:
+                    log.debug('Parsing {} in main process because: {}'
+                              .format(r[2], e))
+            if x is None:
+                x = extract_article_text(s)
             r[1] = x
 
 
@@ -356,21 +564,67 @@ def get_ids_f(filename):
     return r
 
 
+# The sidecar file next to the output feed contains a digest of the
+# feed's ordered ID list, such that checking for changes doesn't
+# require parsing the complete previous feed.
+def ids_digest(ids):
+    return 'sha256:' + hashlib.sha256('\n'.join(ids).encode('utf8')).hexdigest()
+
+
+def sidecar_filename(filename):
+    return filename + '.ids'
+
+
+sidecar_re = re.compile('^sha256:[0-9a-f]{64}$')
+
+
+# returns None if the sidecar is missing or corrupt
+def get_ids_digest_f(filename):
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(sidecar_filename(filename)) as f:
+            s = f.read(128).strip()
+    except OSError:
+        return None
+    if not sidecar_re.match(s):
+        log.warning('Ignoring corrupt sidecar of: ' + filename)
+        return None
+    return s
+
+
+def write_sidecar(filename, digest):
+    tmp = sidecar_filename(filename) + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(digest + '\n')
+    os.replace(tmp, sidecar_filename(filename))
+
+
 att_name_re = re.compile('^[A-Za-z:_][A-Za-z0-9:_.-]+$')
 
+a_attrs = frozenset(('href', 'name', 'rel', 'rev', 'urn', 'title',
+                     'methods', 'id', 'download', 'hreflang', 'ping',
+                     'referrerpolicy', 'target', 'type'))
+
+# attribute name -> att_name_re verdict, i.e. each distinct name is only
+# matched once
+att_name_verdicts = {}
+
+
 def sanitize_tree(t):
     # NB: not necessary, as ElementTree also has iter() method
     # d = t.getroot()
-    a_attrs = set(('href', 'name', 'rel', 'rev', 'urn', 'title',
-                   'methods', 'id', 'download', 'hreflang', 'ping', 'referrerpolicy',
-                   'target', 'type'))
     a_tag = xns + 'a'
+    vs = att_name_verdicts
     for e in t.iter():
+        if not e.attrib:
+            continue
         ds = []
-        for k in e.attrib.keys():
-            if not att_name_re.match(k):
-                ds.append(k)
-            elif e.tag == a_tag and k not in a_attrs:
+        for k in e.attrib:
+            v = vs.get(k)
+            if v is None:
+                v = vs[k] = att_name_re.match(k) is not None
+            if not v or (e.tag == a_tag and k not in a_attrs):
                 ds.append(k)
         for x in ds:
             del e.attrib[x]
@@ -395,12 +649,156 @@ title="Slide: "Classical freedoms must remain mobile" border="0"/>
 
 
 def write_feed(f, args):
-    if get_ids(f) == get_ids_f(args.output) and not args.force:
+    ids = get_ids(f)
+    digest = ids_digest(ids)
+    old = get_ids_digest_f(args.output)
+    if old is None:
+        # i.e. fall back to parsing the previous feed
+        unchanged = ids == get_ids_f(args.output)
+        if unchanged:
+            write_sidecar(args.output, digest)
+    else:
+        unchanged = old == digest
+    if unchanged and not args.force:
         log.debug('''Don't write {} because feed IDs haven't changed'''
                   .format(args.output))
     else:
         log.debug('Writing {} ...'.format(args.output))
-        f.write(args.output)
+        # NB: the feed is replaced before the sidecar, thus, a crash in
+        # between leaves a sidecar that doesn't match, i.e. that only
+        # triggers a superfluous rewrite
+        f.write(args.output + '.tmp')
+        os.replace(args.output + '.tmp', args.output)
+        write_sidecar(args.output, digest)
+
+
+offset_re = re.compile('([?&]offset=)([0-9]+)')
+
+
+def get_offset(url):
+    m = offset_re.search(url)
+    return int(m.group(2)) if m else None
+
+
+def predict_index_urls(url, step, n):
+    m = offset_re.search(url)
+    if not m:
+        return None
+    off = int(m.group(2))
+    return [url[:m.start(2)] + str(off + i * step) + url[m.end(2):]
+            for i in range(n)]
+
+
+def test_predict_index_urls():
+    assert predict_index_urls('https://lwn.net/Articles/?offset=0', 50, 3) == [
+        'https://lwn.net/Articles/?offset=0',
+        'https://lwn.net/Articles/?offset=50',
+        'https://lwn.net/Articles/?offset=100']
+    assert predict_index_urls('https://lwn.net/Articles/', 50, 3) is None
+
+# i.e. the offset difference between two index pages, as observed
+# during the last run
+def load_index_step(cache):
+    try:
+        with open(cache + '/index-step') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def store_index_step(cache, step):
+    with open(cache + '/index-step', 'w') as f:
+        f.write(str(step))
+
+
+# Fetch the first n index pages, either serially, i.e. by following the
+# next links, or in parallel, i.e. by predicting the offsets of the
+# next pages. The prediction is verified against the parsed next
+# links, and on a mismatch, the remaining pages are fetched serially.
+#
+# Paging also stops early when the optional stop predicate returns True
+# for the rows of a page.
+def crawl_index(url, n, session, args, stop=None):
+    step = load_index_step(args.cache)
+    urls = predict_index_urls(url, step, n) if args.jobs > 1 and step else None
+    ss = []
+    if urls:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as ex:
+            ss = list(ex.map(lambda u: get_resource(u, session), urls))
+    rs = []
+    for i in range(n):
+        if i < len(ss) and url != urls[i]:
+            log.warning("Predicted index page {} doesn't match next link {}"
+                        ' - continuing serially'.format(urls[i], url))
+            ss = []
+        s = ss[i] if i < len(ss) else get_resource(url, session)
+        r = parse_headlines_s(s)
+        rs += r[0]
+        next_url = 'https://lwn.net' + r[1]
+        if i == 0:
+            a, b = get_offset(url), get_offset(next_url)
+            # NB: also rewritten if unchanged, as clean_cache() expires
+            # it like any other cached file
+            if a is not None and b is not None and b > a:
+                store_index_step(args.cache, b - a)
+        if stop and stop(r[0]):
+            log.debug('Stop paging at {} because it only contains known articles'
+                      .format(url))
+            break
+        url = next_url
+    return rs
+
+
+# Load the entries of the previous output feed as rows, i.e. as
+# link -> (row, resolved) where row also contains the previous ID.
+# Also returns the links in feed order.
+def load_previous_rows(filename):
+    h = {}
+    ls = []
+    if not os.path.exists(filename):
+        return (h, ls)
+    log.debug('Loading previous entries from {} ...'.format(filename))
+    t = ET.parse(filename)
+    for entry in t.getroot().iter(ans + 'entry'):
+        title = entry.find(ans + 'title')
+        link = entry.find(ans + 'link')
+        content = entry.find(ans + 'content')
+        ident = entry.find(ans + 'id')
+        if (title is None or link is None or content is None or ident is None
+                or len(content) != 1):
+            continue
+        href = link.get('href', '')
+        if not href.startswith('https://lwn.net/'):
+            continue
+        path = href[len('https://lwn.net'):]
+        # i.e. stubs are resolved, again, once they are de-embargoed
+        resolved = (content[0].get('class') == 'ArticleText'
+                    and not stub_re.search(''.join(content[0].itertext())))
+        h[path] = ([title.text, content[0], path, ident.text], resolved)
+        ls.append(path)
+    return (h, ls)
+
+
+# Replace the rows of already resolved articles with their previous
+# entries and fill up with the previous entries that weren't seen
+# during the (early stopped) crawl - up to the previous number of entries.
+def merge_previous_rows(rs, prev, ls):
+    ys = []
+    seen = set()
+    for r in rs:
+        if r[2] in prev and prev[r[2]][1]:
+            ys.append(prev[r[2]][0])
+        else:
+            ys.append(r)
+        seen.add(r[2])
+    n = max(len(ls), len(ys))
+    for link in ls:
+        if len(ys) >= n:
+            break
+        if link not in seen:
+            ys.append(prev[link][0])
+            seen.add(link)
+    return ys
 
 
 def filter_headlines(rs):
@@ -411,21 +809,33 @@ def filter_headlines(rs):
 def main(args):
     rs = []
     session = requests.Session()
+    prev, ls = {}, []
     if args.input:
         for i in args.input:
             rs += parse_headlines_f(i)[0]
     else:
-        url = args.url
-        for _ in range(args.n):
-            s = get_resource(url, session)
-            r = parse_headlines_s(s)
-            rs += r[0]
-            url = 'https://lwn.net' + r[1]
+        stop = None
+        if args.incremental:
+            prev, ls = load_previous_rows(args.output)
+
+            def stop(xs):
+                if not args.all:
+                    xs = filter_headlines(xs)
+                return bool(prev) and all(x[2] in prev and prev[x[2]][1]
+                                          for x in xs)
+        rs += crawl_index(args.url, args.n, session, args, stop)
     if not args.all:
         rs = filter_headlines(rs)
+    if prev:
+        rs = merge_previous_rows(rs, prev, ls)
     resolve_articles(rs, args, session)
     f = mk_feed(rs, args)
-    sanitize_tree(f)
+    # i.e. only sanitize new entries as reused ones were already sanitized
+    # before they were written to the previous feed - and the feed header
+    # only contains our own attributes
+    for r, entry in zip(rs, f.getroot().iterfind(ans + 'entry')):
+        if len(r) <= 3:
+            sanitize_tree(entry)
     ET.indent(f, space='    ')
     update_urls(f, 'https://lwn.net')
     write_feed(f, args)
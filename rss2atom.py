@@ -3,12 +3,22 @@
 # 2017, Georg Sauthoff <mail@gms.tf>, GPLv3+
 
 import argparse
+import concurrent.futures
 import datetime
+import hashlib
 import logging
 import os
+import shutil
+import sqlite3
 import sys
 import re
+import tempfile
 import email.utils
+import io
+import threading
+import time
+import tomllib
+import urllib.parse
 
 import html5lib
 import xml.etree.ElementTree as ET
@@ -22,8 +32,8 @@ import requests
 # we need >= 0.12.3
 import cachecontrol
 assert tuple(int(x) for x in cachecontrol.__version__.split('.')) >= (0, 12, 3)
-from cachecontrol import CacheControl
-from cachecontrol.caches.file_cache import FileCache
+from cachecontrol.adapter import CacheControlAdapter
+from cachecontrol.cache import BaseCache
 import cachecontrol.heuristics
 
 # handle for the module
@@ -60,6 +70,19 @@ def mk_arg_parser():
       help='replace entry content with fetched content (default: fetch)')
   p.add_argument('--no-fetch', action='store_false', dest='fetch',
       help='replace entry content with fetched content (default: fetch)')
+  p.add_argument('--feeds', metavar='TOML',
+      help=('convert multiple feeds (url, output and optional limit and'
+            ' fetch) that are read from a TOML file, i.e. instead of --url'
+            ' and --output'))
+  p.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+      help='fetch up to N articles (and convert up to N feeds) in parallel'
+      ' (default: 1)')
+  p.add_argument('--host-jobs', type=int, default=4, metavar='N',
+      help='send at most N concurrent requests to the same host (default: 4)')
+  p.add_argument('--cache-size', type=int, default=256, metavar='MIB',
+      help='evict the least recently used responses when the cached'
+      ' feeds, articles and teasers add up to more than MIB mebibytes'
+      ' (default: 256)')
   return p
 
 def parse_args(*a):
@@ -83,47 +106,336 @@ def parse_args(*a):
     args.cache = os.environ['HOME'] + '/.cache/feed-util'
   return args
 
-def setup_sessions():
+# Single-file replacement for CacheControl's FileCache, i.e. one table in
+# an SQLite database (in WAL mode), instead of a hashed directory tree with
+# one file (plus lock file) per response.
+#
+# Rows are keyed like FileCache files, i.e. by the SHA-224 of the cache key.
+# Thus, an existing FileCache directory is migrated by just importing its
+# files. When all tables of the database add up to more than max_size
+# bytes, the least recently used rows of any table are evicted.
+class SQLite_Cache(BaseCache):
+
+  def __init__(self, filename, table, max_size=256*1024*1024,
+      migrate_dir=None):
+    self.table = table
+    self.max_size = max_size
+    self.db = sqlite3.connect(filename, timeout=60, isolation_level=None,
+        check_same_thread=False)
+    # i.e. such that the file shrinks after an eviction - a database
+    # created by an earlier version needs to be converted once
+    if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+      self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+      self.db.execute('VACUUM')
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+        key TEXT PRIMARY KEY, value BLOB NOT NULL,
+        size INTEGER NOT NULL, atime INTEGER NOT NULL)''')
+    self.db.execute(f'CREATE INDEX IF NOT EXISTS {table}_atime'
+        f' ON {table} (atime)')
+    if migrate_dir and os.path.isdir(migrate_dir):
+      self.migrate(migrate_dir)
+    # i.e. of all tables, since max_size applies to the whole database -
+    # other connections' insertions are picked up by re-summing after
+    # every max_size/10 bytes inserted through this one
+    self.size = self.total_size()
+    self.unsummed = 0
+
+  def tables(self):
+    return [ x[0] for x in self.db.execute("SELECT name FROM sqlite_master"
+        " WHERE type = 'table' AND name NOT LIKE 'sqlite_%'") ]
+
+  def total_size(self):
+    return sum(self.db.execute(f'SELECT COALESCE(SUM(size), 0) FROM {t}')
+        .fetchone()[0] for t in self.tables())
+
+  @staticmethod
+  def encode(key):
+    return hashlib.sha224(key.encode()).hexdigest()
+
+  def migrate(self, directory):
+    log.info('Migrating FileCache {} ...'.format(directory))
+    with self.db:
+      self.db.execute('BEGIN')
+      for d, _, fs in os.walk(directory):
+        for fn in fs:
+          if len(fn) != 56:
+            # i.e. a lock or temporary file
+            continue
+          filename = os.path.join(d, fn)
+          # i.e. a concurrent run might migrate (and remove) it, as well
+          try:
+            with open(filename, 'rb') as f:
+              value = f.read()
+            t = int(os.path.getmtime(filename))
+          except FileNotFoundError:
+            continue
+          self.db.execute(f'INSERT OR IGNORE INTO {self.table}'
+              ' VALUES (?, ?, ?, ?)', (fn, value, len(value), t))
+    shutil.rmtree(directory, ignore_errors=True)
+
+  def get(self, key):
+    k = self.encode(key)
+    r = self.db.execute(f'SELECT value, atime FROM {self.table}'
+        ' WHERE key = ?', (k,)).fetchone()
+    if r is None:
+      return None
+    # i.e. an access time resolution of a day suffices for the eviction,
+    # but saves a write on most lookups
+    now = int(time.time())
+    if now - r[1] > 24 * 3600:
+      self.db.execute(f'UPDATE {self.table} SET atime = ? WHERE key = ?',
+          (now, k))
+    return r[0]
+
+  def set(self, key, value, expires=None):
+    k = self.encode(key)
+    with self.db:
+      self.db.execute('BEGIN')
+      r = self.db.execute(f'SELECT size FROM {self.table} WHERE key = ?',
+          (k,)).fetchone()
+      self.db.execute(f'INSERT OR REPLACE INTO {self.table}'
+          ' VALUES (?, ?, ?, ?)', (k, value, len(value), int(time.time())))
+    self.size += len(value) - (r[0] if r else 0)
+    self.unsummed += len(value)
+    if self.size > self.max_size or self.unsummed > self.max_size // 10:
+      self.unsummed = 0
+      self.size = self.total_size()
+      if self.size > self.max_size:
+        self.evict()
+
+  def delete(self, key):
+    k = self.encode(key)
+    with self.db:
+      self.db.execute('BEGIN')
+      r = self.db.execute(f'SELECT size FROM {self.table} WHERE key = ?',
+          (k,)).fetchone()
+      self.db.execute(f'DELETE FROM {self.table} WHERE key = ?', (k,))
+    if r:
+      self.size -= r[0]
+
+  # i.e. evict the least recently used rows of all tables down to 90 % of
+  # max_size to amortize the eviction
+  def evict(self):
+    with self.db:
+      self.db.execute('BEGIN')
+      size = self.total_size()
+      q = ' UNION ALL '.join(f"SELECT '{t}', key, size, atime, rowid"
+          f' FROM {t}' for t in self.tables())
+      ks = {}
+      for t, k, n, *_ in self.db.execute(q + ' ORDER BY atime, rowid'):
+        if size <= self.max_size * 9 // 10:
+          break
+        ks.setdefault(t, []).append((k,))
+        size -= n
+      for t, xs in ks.items():
+        log.debug('Evicting {} responses from {}'.format(len(xs), t))
+        self.db.executemany(f'DELETE FROM {t} WHERE key = ?', xs)
+    self.db.execute('PRAGMA incremental_vacuum').fetchall()
+    self.size = size
+
+  def close(self):
+    self.db.close()
+
+def test_sqlite_cache():
+  c = SQLite_Cache(':memory:', 'article', max_size=10000)
+  assert c.get('https://example.org/a') is None
+  c.set('https://example.org/a', b'x' * 1000)
+  c.set('https://example.org/a', b'y' * 1000)
+  assert c.get('https://example.org/a') == b'y' * 1000
+  assert c.size == 1000
+  c.delete('https://example.org/a')
+  assert c.get('https://example.org/a') is None
+  for i in range(11):
+    c.set('https://example.org/{}'.format(i), b'z' * 1000)
+  # i.e. evicted down to 90 % in LRU order
+  assert c.size == 9000
+  assert c.get('https://example.org/1') is None
+  assert c.get('https://example.org/2') == b'z' * 1000
+  c.close()
+  # i.e. the limit applies to all tables of the database
+  with tempfile.TemporaryDirectory() as d:
+    a = SQLite_Cache(d + '/c.sqlite', 'a', max_size=10000)
+    b = SQLite_Cache(d + '/c.sqlite', 'b', max_size=10000)
+    for i in range(6):
+      a.set('https://example.org/{}'.format(i), b'z' * 1000)
+    for i in range(6):
+      b.set('https://example.org/{}'.format(i), b'z' * 1000)
+    assert b.total_size() <= 10000
+    assert b.get('https://example.org/5') == b'z' * 1000
+    a.close()
+    b.close()
+
+# the sqlite3 connections mustn't be used by several threads at the same
+# time - thus, all cache accesses of the fetching threads are serialized
+# (the network I/O still happens concurrently)
+class Locked_Cache(BaseCache):
+
+  def __init__(self, cache):
+    self.cache = cache
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      return self.cache.get(key)
+
+  def set(self, key, value, *xs, **kw):
+    with self.lock:
+      self.cache.set(key, value, *xs, **kw)
+
+  def delete(self, key):
+    with self.lock:
+      self.cache.delete(key)
+
+  def close(self):
+    self.cache.close()
+
+def mk_session(cache, heuristic=None, jobs=1):
+  session = requests.Session()
+  # otherwise urllib3 discards connections beyond its default
+  # pool size of 10 ...
+  a = CacheControlAdapter(cache=Locked_Cache(cache), heuristic=heuristic,
+      pool_maxsize=max(jobs, 10))
+  session.mount('https://', a)
+  session.mount('http://', a)
+  return session
+
+def cache_filename(args):
+  return args.cache + '/rss2atom.sqlite'
+
+# NB: on first use, the directories of the previously used FileCaches
+# (i.e. $cache/feed and $cache/article) are migrated into the database
+def setup_sessions(args):
+  os.makedirs(args.cache, exist_ok=True)
+  filename = cache_filename(args)
+  max_size = args.cache_size * 1024 * 1024
   # as CacheControl patches the session object, we can't share
   # one between both
-  feed_sess = CacheControl(requests.Session(),
-      cache=FileCache(args.cache + '/feed'))
+  feed_sess = mk_session(SQLite_Cache(filename, 'feed', max_size,
+      migrate_dir=args.cache + '/feed'))
   #article_sess = CacheControl(session,
   #    cache=FileCache(args.cache + '/forever', forever=True))
-  article_sess = CacheControl(requests.Session(),
-      cache=FileCache(args.cache + '/article'),
-      heuristic=cachecontrol.heuristics.ExpiresAfter(days=2*365))
+  article_sess = mk_session(SQLite_Cache(filename, 'article', max_size,
+      migrate_dir=args.cache + '/article'),
+      heuristic=cachecontrol.heuristics.ExpiresAfter(days=2*365),
+      jobs=args.jobs)
   return (feed_sess, article_sess)
 
+# per-host connection limit, shared by all fetching threads
+host_limit = 4
+host_sems = {}
+host_sems_lock = threading.Lock()
+
+# shared with heiser.py
+def host_semaphore(url):
+  host = urllib.parse.urlsplit(url).netloc
+  with host_sems_lock:
+    if host not in host_sems:
+      host_sems[host] = threading.BoundedSemaphore(host_limit)
+    return host_sems[host]
+
 # shared with heiser.py
 def get(url, session):
-  log.debug('Getting: {}'.format(url))
-  r = session.get(url)
+  with host_semaphore(url):
+    log.debug('Getting: {}'.format(url))
+    r = session.get(url)
   r.raise_for_status()
   return r.text
 
-def to_feed(s):
-  d = ET.fromstring(s)
-  return d
+# For the pre-scan, i.e. comments and elements whose content isn't parsed
+# as markup are matched such that any tags inside them are skipped.
+raw_elems = r'<(script|style|title|textarea|xmp|iframe|noembed|noframes)\b.*?</\1\s*>'
+prescan_re = re.compile(r'<!--.*?-->|' + raw_elems
+    + r'|(<article\b[^>]*>)|(<div\b[^>]*>)', re.S | re.I)
+post_class_re = re.compile(r'''\sclass\s*=\s*(?:"post"|'post'|post[\s/>])''',
+    re.I)
+doctype_re = re.compile(r'\s*<!DOCTYPE[^>]*>', re.I)
+end_tag_res = {
+  'article': re.compile(r'<!--.*?-->|' + raw_elems + r'|<(/?)article\b[^>]*>',
+      re.S | re.I),
+  'div': re.compile(r'<!--.*?-->|' + raw_elems + r'|<(/?)div\b[^>]*>',
+      re.S | re.I)
+}
 
-def to_article(s):
-  # fix non-conforming html where <mail@example.org> isn't escaped
-  s = re.sub('<([a-zA-Z0-9._-]+@[a-zA-Z0-9.-]+)>', '&lt;\\1&gt;', s)
-  d = html5lib.parse(s, default_treebuilder)
-  xs = d.findall('.//'+xns+'article')
-  if xs:
-    return xs[0]
-  xs = d.findall('.//'+xns+'div[@class="post"]')
-  if xs:
-    return xs[0]
-  xs = d.findall('.//'+xns+'body')
-  if xs:
+# shared with heiser.py
+def find_region_end(s, tag, off):
+  depth = 1
+  for m in end_tag_res[tag].finditer(s, off):
+    if m.group(2) is None:
+      continue
+    depth += -1 if m.group(2) else 1
+    if depth == 0:
+      return m.end()
+  return None
+
+# Locate the element to_article() is looking for, i.e. the first article
+# element or else the first div.post, and wrap it in a minimal document.
+# Thus, html5lib only needs to parse a fraction of the page.
+#
+# Returns None if there is no such region or its end can't be found.
+def prescan_article(s):
+  post = None
+  for m in prescan_re.finditer(s):
+    if m.group(2):
+      start, tag = m, 'article'
+      break
+    if post is None and m.group(3) and post_class_re.search(m.group(3)):
+      post = m
+  else:
+    if post is None:
+      return None
+    start, tag = post, 'div'
+  end = find_region_end(s, tag, start.end())
+  if end is None:
+    return None
+  d = doctype_re.match(s)
+  return ''.join([ d.group(0) if d else '', '<html><body>',
+      s[start.start():end], '</body></html>' ])
+
+def test_prescan_article():
+  inp = '''<!DOCTYPE html><html><head><title><article></title>
+<script>x = '<div class="post">';</script></head><body><div class=post>
+<!-- <article> --><p>a</div><article class="x"><div>a<script>"</article>"</script>
+</div><p>b</article><footer>f</footer></body></html>'''
+  assert prescan_article(inp) == ('<!DOCTYPE html><html><body><article '
+      'class="x"><div>a<script>"</article>"</script>\n</div><p>b</article>'
+      '</body></html>')
+  inp = '<html><div class="posts">x</div><div class="post"><div>a</div></div>'
+  assert prescan_article(inp) == ('<html><body><div class="post"><div>a</div>'
+      '</div></body></html>')
+  assert prescan_article('<html><div class="post"><div>a</div>') is None
+  assert prescan_article('<html><body><p>a</p></body></html>') is None
+
+def find_article(d):
+  post = body = None
+  for e in d.iter():
+    if e.tag == xns+'article':
+      return e
+    elif post is None and e.tag == xns+'div' and e.get('class') == 'post':
+      post = e
+    elif body is None and e.tag == xns+'body':
+      body = e
+  if post is not None:
+    return post
+  if body is not None:
     a = ET.Element(xns+'article')
-    for i in xs[0]:
+    for i in body:
       a.append(i)
     return a
   raise RuntimeError('''Didn't find article nor body element.''')
 
+email_re = re.compile('<([a-zA-Z0-9._-]+@[a-zA-Z0-9.-]+)>')
+
+def to_article(s):
+  x = prescan_article(s)
+  if x is not None:
+    s = x
+  # fix non-conforming html where <mail@example.org> isn't escaped
+  s = email_re.sub('&lt;\\1&gt;', s)
+  d = html5lib.parse(s, default_treebuilder)
+  return find_article(d)
+
 def to_isodate(s):
   t = email.utils.parsedate_tz(s)
   z = 'Z'
@@ -172,30 +484,137 @@ def updated(off=0):
   updated.text = (now - datetime.timedelta(hours=off)).isoformat()[:-6] + 'Z'
   return updated
 
-def rss2atom(rss_feed, url, use_description, n):
-  channel = rss_feed.find('channel')
+# Converts the RSS document while it's parsed, i.e. each item is dropped
+# after its entry is created and parsing stops after n items.
+# Thus, the memory usage doesn't depend on the size of the document.
+#
+# In case the channel title and link follow the items, the remaining items
+# are skipped (without converting them) until both are seen.
+def rss2atom(f, url, use_description, n):
+  entries = []
+  title = link = channel = None
+  path = []
+  for ev, e in ET.iterparse(f, events=('start', 'end')):
+    if ev == 'start':
+      if (e.tag == 'item' and len(entries) >= n and title is not None
+          and link is not None):
+        break
+      if path == ['rss'] and e.tag == 'channel':
+        channel = e
+      path.append(e.tag)
+      continue
+    path.pop()
+    if e.tag == 'item' and channel is not None:
+      if len(entries) < n:
+        entries.append(item2entry(e, url, use_description))
+      channel.remove(e)
+    elif e is channel:
+      break
+    elif path == ['rss', 'channel']:
+      if e.tag == 'title':
+        title = e.text
+      elif e.tag == 'link':
+        link = e.text
   feed = ET.Element(ans + 'feed')
-  ET.SubElement(feed, ans+'title').text = channel.find('title').text
+  ET.SubElement(feed, ans+'title').text = title
   ET.SubElement(feed, ans+'link', rel='alternate', type='text/html',
-      href=channel.find('link').text)
-  ET.SubElement(feed, ans+'id').text = channel.find('link').text
+      href=link)
+  ET.SubElement(feed, ans+'id').text = link
   feed.append(updated())
-  for _, item in zip(range(n), channel.findall('.//item')):
-    feed.append(item2entry(item, url, use_description))
+  for entry in entries:
+    feed.append(entry)
   return ET.ElementTree(feed)
 
-def enrich_content(feed, session):
-  for entry in feed.findall('.//'+ans+'entry'):
-    url = entry.find(ans+'link').get('href')
-    a = to_article(get(url, session))
-    if sum(1 for _ in a.iter()) < 20:
-      us = [ x.get('href') for x in a.findall('.//'+xns+'a') if x.get('href') ]
-      if us and us.__len__() < 5:
-        url = us[0]
-        a = to_article(get(url, session))
-    update_urls(a, url)
-    content = entry.find(ans+'content')
-    content.insert(0, a)
+def test_rss2atom():
+  items = ''.join('''<item><title>t{0}</title><guid>g{0}</guid>
+      <pubDate>Wed, 07 Jun 2017 00:00:00 +0000</pubDate>
+      <link>https://example.org/{0}</link><description>d</description></item>'''
+      .format(i) for i in range(5))
+  s = '''<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>
+      <title>Example</title><link>https://example.org/</link>{}
+      </channel></rss>'''.format(items)
+  d = rss2atom(io.BytesIO(s.encode()), 'https://example.org/', False, 3)
+  assert d.find(ans+'title').text == 'Example'
+  assert d.find(ans+'id').text == 'https://example.org/'
+  assert [ e.find(ans+'id').text for e in d.iter(ans+'entry') ] == [
+      'g0', 'g1', 'g2' ]
+  s = '''<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>
+      {}<title>Example</title><link>https://example.org/</link>
+      </channel></rss>'''.format(items)
+  d = rss2atom(io.BytesIO(s.encode()), 'https://example.org/', False, 3)
+  assert d.find(ans+'link').get('href') == 'https://example.org/'
+  assert len(list(d.iter(ans+'entry'))) == 3
+
+# Teaser memo, i.e. entry URL -> the article that was extracted from the
+# page the short teaser page links to (and that page's URL). Such entries
+# then don't require two fetches and parses on each run.
+def open_teasers(args):
+  return Locked_Cache(SQLite_Cache(cache_filename(args), 'teaser',
+      args.cache_size * 1024 * 1024))
+
+def load_teaser(teasers, url):
+  x = teasers.get(url)
+  if x is None:
+    return None
+  # i.e. also keep the comments html5lib inserted
+  p = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+  try:
+    d = ET.fromstring(x, parser=p)
+  except ET.ParseError as e:
+    log.warning('Ignoring corrupt teaser memo for {}: {}'.format(url, e))
+    return None
+  log.debug('Found memoized article {} for teaser {}'.format(d.get('url'),
+      url))
+  return d[0]
+
+def store_teaser(teasers, url, article_url, a):
+  d = ET.Element('teaser', url=article_url)
+  d.append(a)
+  x = ET.tostring(d)
+  try:
+    # i.e. html5lib also yields attribute names that aren't well-formed XML
+    ET.fromstring(x)
+  except ET.ParseError as e:
+    log.debug('''Don't memoize teaser {}: {}'''.format(url, e))
+    return
+  teasers.set(url, x)
+
+def test_teaser_memo():
+  teasers = SQLite_Cache(':memory:', 'teaser')
+  a = to_article('<article><!-- c --><p class="x">a <b>b</b></p></article>t')
+  store_teaser(teasers, 'https://example.org/t', 'https://example.org/a', a)
+  b = load_teaser(teasers, 'https://example.org/t')
+  assert ET.tostring(b) == ET.tostring(a)
+  assert load_teaser(teasers, 'https://example.org/u') is None
+
+def fetch_article(url, session, teasers=None):
+  if teasers is not None:
+    a = load_teaser(teasers, url)
+    if a is not None:
+      return a
+  a = to_article(get(url, session))
+  if sum(1 for _ in a.iter()) < 20:
+    us = [ x.get('href') for x in a.findall('.//'+xns+'a') if x.get('href') ]
+    if us and us.__len__() < 5:
+      article_url = us[0]
+      a = to_article(get(article_url, session))
+      update_urls(a, article_url)
+      if teasers is not None:
+        store_teaser(teasers, url, article_url, a)
+      return a
+  update_urls(a, url)
+  return a
+
+def enrich_content(feed, session, jobs=1, teasers=None):
+  entries = feed.findall('.//'+ans+'entry')
+  urls = [ entry.find(ans+'link').get('href') for entry in entries ]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as ex:
+    # i.e. map() yields the articles in entry order
+    f = lambda url: fetch_article(url, session, teasers)
+    xs = ex.map(f, urls) if jobs > 1 else map(f, urls)
+    for entry, a in zip(entries, xs):
+      content = entry.find(ans+'content')
+      content.insert(0, a)
 
 # shared with heiser.py
 def update_urls(a, url):
@@ -228,20 +647,54 @@ def update_urls(a, url):
 def base_url(s):
   return s[0:s.find('/', s.find('://')+3)]
 
-def main(args):
-  feed_sess, article_sess = setup_sessions()
-  req = feed_sess.get(args.url)
+def load_jobs(args):
+  if not args.feeds:
+    return [ { 'url': args.url, 'output': args.output, 'limit': args.limit,
+               'fetch': args.fetch } ]
+  with open(args.feeds, 'rb') as f:
+    feeds = tomllib.load(f)
+  return [ { 'url': feed['url'], 'output': feed['output'],
+             'limit': feed.get('limit', args.limit),
+             'fetch': feed.get('fetch', args.fetch) }
+           for feed in feeds['feed'] ]
+
+def convert_feed(job, args, feed_sess, article_sess, teasers):
+  req = feed_sess.get(job['url'])
   req.raise_for_status()
   log.debug(req.headers)
   if req.from_cache and not args.force:
-    log.debug('Do nothing because because feed is still cached')
+    log.debug('Do nothing because feed is still cached: ' + job['url'])
+    return
+  feed = rss2atom(io.BytesIO(req.content), job['url'], not job['fetch'],
+      job['limit'])
+  if job['fetch']:
+    enrich_content(feed, article_sess, args.jobs, teasers)
+  feed.write(job['output'])
+
+def main(args):
+  global host_limit
+  host_limit = args.host_jobs
+  feed_sess, article_sess = setup_sessions(args)
+  teasers = open_teasers(args)
+  jobs = load_jobs(args)
+  if not args.feeds:
+    convert_feed(jobs[0], args, feed_sess, article_sess, teasers)
     return 0
-  rss_feed = to_feed(req.text)
-  feed = rss2atom(rss_feed, args.url, not args.fetch, args.limit)
-  if args.fetch:
-    enrich_content(feed, article_sess)
-  feed.write(args.output)
-  return 0
+  # i.e. in batch mode, a broken feed doesn't stop the others
+  def f(job):
+    try:
+      convert_feed(job, args, feed_sess, article_sess, teasers)
+      return True
+    except (requests.exceptions.RequestException, ET.ParseError) as e:
+      log.error('Failed to convert {}: {}'.format(job['url'], e))
+      return False
+    # i.e. also for a malformed item or an unexpected article page
+    except Exception:
+      log.exception('Failed to convert {}'.format(job['url']))
+      return False
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as ex:
+    rs = list(ex.map(f, jobs))
+  return 0 if all(rs) else 1
 
 if __name__ == '__main__':
   setup_logging()